@@ -1,25 +1,181 @@
-from twisted.internet import reactor, defer, protocol
+from twisted.internet import reactor, defer, protocol, threads
 from twisted.mail import imap4
 from zope.interface import implementer
 import os
+import time
 import argparse
 import email.utils
-from email.parser import HeaderParser
 from io import BytesIO
 import csv
+import mmap
+import hmac
+import threading
+from collections import OrderedDict
 from twisted.cred import portal, credentials, checkers, error as credError
 
+# Parser de correos en Rust, opcional; si no está instalado se usa _parse_header_block.
+try:
+    from fast_mail_parser import parse_email, ParseError
+    FAST_PARSER = True
+except ImportError:
+    FAST_PARSER = False
+
+# Tiempo máximo (en segundos) que se confía en el listado en caché de un buzón,
+# por si la resolución del mtime del sistema de archivos es gruesa.
+REFRESH_TTL = 2.0
+
+# Tamaño del pool de hilos usado para las lecturas de disco fuera del reactor.
+THREAD_POOL_SIZE = 16
+
+# Cantidad de mensajes cuyo contenido se lee por lote, en el pool de hilos, durante un FETCH.
+FETCH_BATCH_SIZE = 100
+
+# Tamaño de los bloques leídos al buscar el fin de los encabezados de un mensaje.
+HEADER_CHUNK_SIZE = 4096
+
+# Cantidad de bytes iniciales donde se busca primero el fin de los encabezados.
+HEADER_SCAN_LIMIT = 64 * 1024
+
+# Elemento FLAGS de un mensaje sin banderas, y caché de los elementos FLAGS ya
+# codificados por combinación de banderas.
+EMPTY_FLAGS_TUPLE = (b"FLAGS", b"()")
+_FLAGS_CACHE = {}
+
+# Tamaño (en bytes) a partir del cual un mensaje se mapea en memoria en lugar de leerse.
+MMAP_THRESHOLD = 256 * 1024
+
+# Límites de la caché en memoria de contenidos de mensajes (cantidad de entradas y bytes totales).
+MESSAGE_CACHE_MAX_ENTRIES = 1024
+MESSAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+# Caché LRU de contenidos de mensajes, acotada en cantidad de entradas y en bytes.
+# Se usa desde el pool de hilos, por lo que los accesos se protegen con un lock.
+class _MessageCache:
+
+    # Constructor:
+    # max_entries: cantidad máxima de mensajes en caché
+    # max_bytes: suma máxima de los tamaños de los mensajes en caché
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Devuelve el contenido asociado a la clave, o None si no está en caché.
+    def get(self, key):
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+            return content
+
+    # Guarda un contenido y descarta los menos usados si se superan los límites.
+    def put(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._entries[key] = content
+            self.total_bytes += len(content)
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+
+MESSAGE_CACHE = _MessageCache(MESSAGE_CACHE_MAX_ENTRIES, MESSAGE_CACHE_MAX_BYTES)
+
+
+# Lee el contenido de un archivo de mensaje.
+# Los mensajes pequeños se devuelven como bytes y se guardan en MESSAGE_CACHE con clave
+# (ruta, mtime), de modo que reescribir el archivo invalida la entrada. Los que superan
+# MMAP_THRESHOLD se mapean en memoria (solo lectura) para que el page cache del sistema sirva
+# el contenido sin copiarlo; el mapa se libera junto con el último objeto que lo referencia.
+def _read_message(file_path):
+    st = os.stat(file_path)
+    if st.st_size > MMAP_THRESHOLD:
+        with open(file_path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    key = (file_path, st.st_mtime_ns)
+    content = MESSAGE_CACHE.get(key)
+    if content is None:
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        MESSAGE_CACHE.put(key, content)
+    return content
+
+
+# Archivo de solo lectura sobre un mensaje mapeado en memoria, con posición propia
+# para que cada lector pueda recorrer el mismo mapa de forma independiente.
+class _MappedFile:
+
+    # Constructor:
+    # mapped: objeto mmap con el contenido del mensaje
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.mapped) if size is None or size < 0 else self.pos + size
+        data = self.mapped[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.mapped)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+
+# Analiza un bloque de encabezados en bytes y devuelve un diccionario nombre -> valor.
+# Solo se necesita la separación "Nombre: valor" de RFC 5322: las líneas que empiezan con
+# espacio o tabulación continúan el encabezado anterior y se conservan con su salto de línea.
+# Como con email.parser.HeaderParser, si un encabezado se repite se conserva el último valor.
+def _parse_header_block(block):
+    headers = {}
+    name = value = None
+    for line in block.splitlines():
+        if line[:1] in (b" ", b"\t"):
+            if name is not None:
+                value += b"\n" + line
+            continue
+        if name is not None:
+            headers[name.decode("utf-8", errors="replace")] = value.decode("utf-8", errors="replace")
+        idx = line.find(b":")
+        if idx < 0:
+            name = None
+            continue
+        name, value = line[:idx], line[idx + 1:].lstrip(b" \t")
+    if name is not None:
+        headers[name.decode("utf-8", errors="replace")] = value.decode("utf-8", errors="replace")
+    return headers
+
+
 # Clase que encapsula los detalles de un correo electrónico, ofreciendo métodos para obtener información
 # relevante del mensaje para el funcionamiento del protocolo IMAP.
 @implementer(imap4.IMessage)
 class SimpleMessage:
 
     # Constructor:
-    # content: contenido completo del mensaje (texto)
+    # content: contenido completo del mensaje (bytes, o mmap para mensajes grandes)
     # uid: identificador único del mensaje
     def __init__(self, content, uid):
         self.content = content
         self.uid = uid
+        self._headers_cache = None
 
     # Devuelve el UID del mensaje.
     def getUID(self):
@@ -37,45 +193,127 @@ class SimpleMessage:
     # Devuelve únicamente los encabezados del mensaje.
     # Separa los encabezados del cuerpo usando la doble línea en blanco.
     def getRFC822Headers(self):
-        headers, _, _ = self.content.partition("\n\n")
-        return headers
+        return self._header_block().decode("utf-8", errors="replace")
+
+    # Devuelve el bloque de encabezados sin decodificar.
+    # La búsqueda se limita primero a HEADER_SCAN_LIMIT bytes y solo recorre el resto
+    # del mensaje si los encabezados son más largos.
+    def _header_block(self):
+        idx = self.content.find(b"\n\n", 0, HEADER_SCAN_LIMIT)
+        if idx < 0:
+            idx = self.content.find(b"\n\n", max(HEADER_SCAN_LIMIT - 1, 0))
+        return self.content[:idx] if idx >= 0 else self.content[:]
 
     # Devuelve el mensaje completo en formato RFC822.
     def getRFC822Text(self):
         return self.content
 
-    # Devuelve el tamaño del mensaje (en bytes, codificado en UTF-8).
+    # Devuelve el tamaño del mensaje (en bytes).
     def getSize(self):
 
-        return len(self.content.encode("utf-8"))
+        return len(self.content)
 
     # Indica si el mensaje es multipart
     def isMultipart(self):
 
         return False
 
-    # Devuelve un objeto BytesIO con el contenido completo del mensaje.
+    # Devuelve un archivo nuevo sobre el contenido completo del mensaje: un BytesIO, que comparte
+    # el buffer de los bytes originales mientras no se escriba en él, o un _MappedFile si el
+    # mensaje está mapeado en memoria.
     def getBodyFile(self):
 
-        return BytesIO(self.getRFC822Text().encode("utf-8"))
+        if isinstance(self.content, mmap.mmap):
+            return _MappedFile(self.content)
+        return BytesIO(self.content)
+
+    # Cierra el mapa en memoria del mensaje, si lo tiene. Los contenidos en bytes no se tocan,
+    # ya que pueden estar compartidos con MESSAGE_CACHE.
+    def close(self):
+        if isinstance(self.content, mmap.mmap):
+            self.content.close()
 
     # Devuelve un diccionario con los encabezados filtrados.
     # Si se especifican campos, se devuelven (o se excluyen si 'negate' es True) según la lista.
+    # Los encabezados se analizan una sola vez y se guardan junto con su nombre en minúsculas.
     def getHeaders(self, negate, *fields):
-        parser = HeaderParser()
-        headers_str = self.getRFC822Headers()
-        msg = parser.parsestr(headers_str)
-        headers_dict = dict(msg.items())
-        if fields:
+        if self._headers_cache is None:
+            self._headers_cache = [(k.lower(), k, v) for k, v in self._parse_headers().items()]
+        if not fields:
+            return {k: v for _, k, v in self._headers_cache}
+
+        fields_lower = {f.decode("utf-8").lower() if isinstance(f, bytes) else f.lower() for f in fields}
+        if not negate:
 
-            fields_lower = [f.decode("utf-8").lower() if isinstance(f, bytes) else f.lower() for f in fields]
-            if not negate:
+            return {k: v for lower, k, v in self._headers_cache if lower in fields_lower}
+        else:
+
+            return {k: v for lower, k, v in self._headers_cache if lower not in fields_lower}
 
-                headers_dict = {k: v for k, v in headers_dict.items() if k.lower() in fields_lower}
+    # Analiza el bloque de encabezados y devuelve un diccionario nombre -> valor.
+    # Usa fast_mail_parser si está disponible y recurre a _parse_header_block si falla.
+    # fast_mail_parser entrega una lista de valores por encabezado; se conserva el último.
+    def _parse_headers(self):
+        if FAST_PARSER:
+            try:
+                headers = parse_email(self._header_block() + b"\n\n").headers
+            except ParseError:
+                pass
             else:
+                return {k: v[-1] if isinstance(v, list) else v for k, v in headers.items() if v}
+        return _parse_header_block(self._header_block())
+
+# Mensaje que se lee de disco solo cuando es necesario.
+# El tamaño se obtiene del sistema de archivos y los encabezados se leen sin cargar el cuerpo;
+# el contenido completo se lee (una sola vez) al solicitar el texto o el cuerpo del mensaje.
+class LazyMessage(SimpleMessage):
 
-                headers_dict = {k: v for k, v in headers_dict.items() if k.lower() not in fields_lower}
-        return headers_dict
+    # Constructor:
+    # file_path: ruta del archivo .eml del mensaje
+    # uid: identificador único del mensaje
+    def __init__(self, file_path, uid):
+        self.file_path = file_path
+        self.uid = uid
+        self._content = None
+        self._headers_cache = None
+
+    # Contenido completo del mensaje, leído de disco en el primer acceso.
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = _read_message(self.file_path)
+        return self._content
+
+    # Devuelve el tamaño del mensaje sin leerlo.
+    def getSize(self):
+        if self._content is None:
+            return os.path.getsize(self.file_path)
+        return len(self._content)
+
+    # Devuelve los encabezados leyendo el archivo por bloques hasta la doble línea en blanco.
+    # Igual que en SimpleMessage, la búsqueda por bloques se limita a HEADER_SCAN_LIMIT bytes;
+    # si los encabezados son más largos se lee el contenido completo.
+    def _header_block(self):
+        if self._content is not None:
+            return super()._header_block()
+        headers = bytearray()
+        with open(self.file_path, 'rb') as f:
+            while len(headers) < HEADER_SCAN_LIMIT:
+                chunk = f.read(HEADER_CHUNK_SIZE)
+                start = max(len(headers) - 1, 0)
+                headers += chunk
+                idx = headers.find(b"\n\n", start)
+                if idx >= 0:
+                    return bytes(headers[:idx])
+                if not chunk:
+                    return bytes(headers)
+        return super()._header_block()
+
+    # Cierra el mapa en memoria, si se llegó a leer el contenido; un acceso posterior lo vuelve a leer.
+    def close(self):
+        if isinstance(self._content, mmap.mmap):
+            self._content.close()
+        self._content = None
 
 #Clase de excepcion cuando no se encuientra el mensaje solicitado
 class NoSuchMessage(imap4.MailboxException):
@@ -110,6 +348,30 @@ class FetchResult(list):
         return self.message.getBodyFile()
 
 
+# Devuelve el elemento (b"FLAGS", b"(...)") para una lista de banderas.
+# Las combinaciones ya codificadas se reutilizan desde _FLAGS_CACHE.
+def _flags_item(flags):
+    if not flags:
+        return EMPTY_FLAGS_TUPLE
+    key = tuple(flags)
+    item = _FLAGS_CACHE.get(key)
+    if item is None:
+        item = (b"FLAGS", b'(' + b' '.join(flag.encode("utf-8") for flag in flags) + b')')
+        _FLAGS_CACHE[key] = item
+    return item
+
+
+# Indica si una consulta FETCH necesita el contenido completo de los mensajes: RFC822, RFC822.TEXT
+# y las secciones BODY[] o BODY[TEXT]. Los encabezados, el tamaño y las banderas no lo necesitan.
+def _query_needs_body(query):
+    for part in query:
+        if part.type in ("rfc822", "rfc822text"):
+            return True
+        if part.type == "body" and (part.text or part.empty):
+            return True
+    return False
+
+
 #Clase que representa un buzón de correo basado en un directorio en disco.
 @implementer(imap4.IMailbox)
 class DiskMailbox:
@@ -119,15 +381,40 @@ class DiskMailbox:
         self.path = path
         if not os.path.isdir(path):
             raise Exception("El buzón de correo no existe: {}".format(path))
+        self._mtime_ns = -1
+        self._refreshed_at = 0.0
+        self._entries = {}
+        self._names = []
+        self.messages = []
+        self.uid_to_path = {}
         self.refresh()
 
     # Actualiza la lista de mensajes leyendo el directorio.
+    # El listado se mantiene en caché y solo se reconstruye cuando cambia el mtime
+    # del directorio o cuando expira REFRESH_TTL.
+    # Como el servidor SMTP nombra los archivos de forma creciente, lo habitual es que solo
+    # aparezcan archivos nuevos al final: en ese caso se agregan sin volver a ordenar todo.
     def refresh(self):
-        self.messages = []
-        for f in sorted(os.listdir(self.path)):
-            file_path = os.path.join(self.path, f)
-            if os.path.isfile(file_path):
-                self.messages.append(file_path)
+        st = os.stat(self.path)
+        now = time.monotonic()
+        if st.st_mtime_ns == self._mtime_ns and now - self._refreshed_at < REFRESH_TTL:
+            return
+        with os.scandir(self.path) as it:
+            entries = {e.name: e.path for e in it if e.is_file(follow_symlinks=False)}
+        added = sorted(name for name in entries if name not in self._entries)
+        nothing_removed = len(entries) - len(added) == len(self._entries)
+        if nothing_removed and (not added or not self._names or added[0] > self._names[-1]):
+            for name in added:
+                self._names.append(name)
+                self.messages.append(entries[name])
+                self.uid_to_path[len(self.messages)] = entries[name]
+        else:
+            self._names = sorted(entries)
+            self.messages = [entries[name] for name in self._names]
+            self.uid_to_path = {uid: file_path for uid, file_path in enumerate(self.messages, 1)}
+        self._entries = entries
+        self._mtime_ns = st.st_mtime_ns
+        self._refreshed_at = now
         self.uidValidity = 1
 
     # Devuelve un rango de números de mensaje, basado en la cantidad de archivos.
@@ -135,59 +422,122 @@ class DiskMailbox:
         self.refresh()
         return range(1, len(self.messages) + 1)
 
+    # Lee el contenido completo de un archivo de mensaje (ver _read_message).
+    def _read_file(self, file_path):
+        return _read_message(file_path)
+
     # Devuelve un mensaje (instancia de SimpleMessage) dado su número.
+    # La lectura del archivo se realiza en el pool de hilos para no bloquear el reactor.
     def getMessage(self, num):
-        if 1 <= num <= len(self.messages):
-            file_path = self.messages[num - 1]
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except Exception:
-                return defer.fail(NoSuchMessage(num))
-            message = SimpleMessage(content, uid=num)
-            return defer.succeed(message)
+        file_path = self.uid_to_path.get(num)
+        if file_path is not None:
+            d = threads.deferToThread(self._read_file, file_path)
+            d.addCallbacks(lambda content: SimpleMessage(content, uid=num),
+                           lambda _: defer.fail(NoSuchMessage(num)))
+            return d
         else:
             return defer.fail(NoSuchMessage(num))
 
     # Método para obtener mensajes en bloque.
-    # messages: lista de números de mensajes o un objeto iterable.
+    # messages: lista de números de mensajes, un objeto iterable o un imap4.MessageSet
+    # (que puede terminar en '*').
     # uid: si se solicita el UID
-    def fetch(self, messages, uid=False):
-        results = {}
-        deferreds = []
-        try:
+    # body: si la consulta necesita el contenido de los mensajes (ver _query_needs_body)
+    # Cada FetchResult incluye solo FLAGS; el resto del mensaje lo obtiene el servidor IMAP
+    # a través de los métodos de acceso del mensaje. Si no se pide el contenido, se entregan
+    # LazyMessage, que leen de disco solo lo que se use (tamaño o encabezados). Si se pide, los
+    # contenidos se leen en el pool de hilos de a FETCH_BATCH_SIZE mensajes: el Deferred retornado
+    # se dispara cuando está listo el primer lote, y cada lote siguiente se lee mientras se envía
+    # el anterior.
+    def fetch(self, messages, uid=False, body=False):
+        self.refresh()
+        if isinstance(messages, imap4.MessageSet):
+            msg_nums = []
+            for first, last in messages.ranges:
+                msg_nums.extend(self._uid_range(first, last))
+        else:
             msg_nums = list(messages)
-        except TypeError as e:
-            if "last value not set" in str(e):
-                start = getattr(messages, "first", 1)
-                msg_nums = list(range(start, self.getMessageCount() + 1))
-            else:
-                raise
 
+        if not body:
+            return defer.succeed(self._fetch_items(self._lazy_messages(msg_nums)))
+        d = self._load_batch(msg_nums[:FETCH_BATCH_SIZE])
+        d.addCallback(lambda batch: self._fetch_results(msg_nums, batch))
+        return d
+
+    # Construye los resultados del FETCH a medida que el servidor IMAP los consume.
+    # batch: primer lote de mensajes ya leído. Al empezar a entregar un lote se pide la lectura
+    # del siguiente; si al llegar a él todavía no terminó, sus mensajes se entregan como
+    # LazyMessage, que leen el archivo (normalmente ya en MESSAGE_CACHE) al usarse.
+    def _fetch_results(self, msg_nums, batch):
+        for start in range(0, len(msg_nums), FETCH_BATCH_SIZE):
+            following = msg_nums[start + FETCH_BATCH_SIZE:start + 2 * FETCH_BATCH_SIZE]
+            loaded = []
+            if following:
+                self._load_batch(following).addCallback(loaded.append)
+            yield from self._fetch_items(batch)
+            batch = loaded[0] if loaded else self._lazy_messages(following)
+
+    # Entrega un FetchResult por mensaje. El servidor IMAP pide el siguiente resultado recién
+    # cuando terminó de enviar el anterior, así que en ese momento se cierra el mapa en memoria
+    # del mensaje ya enviado en vez de esperar a que se libere el lote completo.
+    def _fetch_items(self, messages):
+        for msg in messages:
+            yield msg.getUID(), FetchResult(msg, [_flags_item(msg.getFlags())])
+            msg.close()
+
+    # Retorna un Deferred con la lista de SimpleMessage de los mensajes indicados, cuyos
+    # contenidos se leen en el pool de hilos para no bloquear el reactor.
+    def _load_batch(self, msg_nums):
+        paths = [(msgnum, self.uid_to_path[msgnum]) for msgnum in msg_nums if msgnum in self.uid_to_path]
+        if not paths:
+            return defer.succeed([])
+        return threads.deferToThread(self._read_batch, paths)
+
+    # Lee (fuera del hilo del reactor) el contenido de cada mensaje (ver _read_message).
+    # Los mensajes grandes quedan mapeados en memoria y se pide al kernel que los cargue por
+    # adelantado (MADV_WILLNEED). Los mensajes que no se pueden leer se omiten.
+    def _read_batch(self, paths):
+        batch = []
+        for msgnum, file_path in paths:
+            try:
+                content = _read_message(file_path)
+            except OSError:
+                continue
+            if isinstance(content, mmap.mmap) and hasattr(mmap, "MADV_WILLNEED"):
+                content.madvise(mmap.MADV_WILLNEED)
+            batch.append(SimpleMessage(content, uid=msgnum))
+        return batch
+
+    # Genera instancias de LazyMessage para los mensajes solicitados.
+    def _lazy_messages(self, msg_nums):
         for msgnum in msg_nums:
-            d = self.getMessage(msgnum)
-
-            def add_result(msg, msgnum=msgnum):
-                flags = msg.getFlags()
-                if flags:
-                    flags_bytes = b'(' + b' '.join(flag.encode("utf-8") for flag in flags) + b')'
-                else:
-                    flags_bytes = b'()'
-                return FetchResult(msg, [(b"FLAGS", flags_bytes), (b"RFC822", msg.getRFC822Text().encode("utf-8"))])
-
-            d.addCallback(add_result)
-            d.addCallback(lambda result, msgnum=msgnum: results.__setitem__(msgnum, result))
-            deferreds.append(d)
-        return defer.DeferredList(deferreds).addCallback(lambda _: list(results.items()))
+            file_path = self.uid_to_path.get(msgnum)
+            if file_path is not None:
+                yield LazyMessage(file_path, uid=msgnum)
+
+    # Devuelve, ordenados, los UID existentes entre first y last (inclusive).
+    # None representa '*', es decir el mayor número en uso (RFC 3501): "n:*" equivale a "*:n",
+    # por lo que con n mayor a la cantidad de mensajes se entrega igualmente el último.
+    def _uid_range(self, first, last):
+        count = len(self.messages)
+        if first is None:
+            first = count
+        if last is None:
+            last = count
+        if first > last:
+            first, last = last, first
+        return list(range(max(first, 1), min(last, count) + 1))
 
     # Proporciona el estado del buzón en base a los nombres solicitados.
+    # El listado se actualiza una sola vez y todos los valores se calculan sobre él.
     def requestStatus(self, names):
 
+        self.refresh()
         result = {}
         for name in names:
             upperName = name.upper()
             if upperName == b"MESSAGES":
-                result[b"MESSAGES"] = self.getMessageCount()
+                result[b"MESSAGES"] = len(self.messages)
             elif upperName == b"RECENT":
                 result[b"RECENT"] = self.getRecentCount()
             elif upperName == b"UIDNEXT":
@@ -313,30 +663,66 @@ class CSVChecker:
 
     # Constructor:
     # csv_path: ruta del archivo CSV que contiene las credenciales de los usuarios.
+    # Las credenciales se guardan como bytes, igual que llegan desde el protocolo.
+    # Se usa csv.reader y las columnas se ubican por su nombre en la fila de encabezado.
     def __init__(self, csv_path):
-        self.users = {}
         with open(csv_path, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-
-                email_addr = row['email'].strip()
-                passwd = row['password'].strip()
-                self.users[email_addr] = passwd
+            reader = csv.reader(f)
+            header = [name.strip() for name in next(reader)]
+            email_idx = header.index('email')
+            passwd_idx = header.index('password')
+            min_len = max(email_idx, passwd_idx) + 1
+            self.users = {row[email_idx].strip().encode('utf-8'): row[passwd_idx].strip().encode('utf-8')
+                          for row in reader if len(row) >= min_len}
 
     # Método que verifica las credenciales proporcionadas.
+    # La contraseña se compara en tiempo constante.
     def requestAvatarId(self, creds):
 
-        username = creds.username.decode('utf-8') if isinstance(creds.username, bytes) else creds.username
-        password = creds.password.decode('utf-8') if isinstance(creds.password, bytes) else creds.password
-        if username in self.users and self.users[username] == password:
-            return defer.succeed(username)
+        username = creds.username if isinstance(creds.username, bytes) else creds.username.encode('utf-8')
+        password = creds.password if isinstance(creds.password, bytes) else creds.password.encode('utf-8')
+        stored = self.users.get(username)
+        if stored is not None and hmac.compare_digest(stored, password):
+            return defer.succeed(username.decode('utf-8'))
         return defer.fail(credError.UnauthorizedLogin("Usuario o contraseña inválidos"))
 
 
 
+# Servidor IMAP que recibe el portal y los mecanismos de autenticación en su constructor.
+class DiskIMAPServer(imap4.IMAP4Server):
+    # Constructor:
+    # portal: instancia de portal.Portal usada para autenticar
+    # challengers: diccionario mecanismo -> clase de credenciales (se comparte entre conexiones;
+    # IMAP4Server lo copia antes de modificarlo)
+    def __init__(self, portal, challengers):
+        imap4.IMAP4Server.__init__(self, chal=challengers)
+        self.portal = portal
+
+    # Igual que IMAP4Server.do_FETCH, pero indica al buzón si la consulta necesita el contenido
+    # de los mensajes, para no leerlos completos cuando solo se piden banderas, tamaños o encabezados.
+    def do_FETCH(self, tag, messages, query, uid=0):
+        if not query:
+            return imap4.IMAP4Server.do_FETCH(self, tag, messages, query, uid)
+        self._oldTimeout = self.setTimeout(None)
+        defer.maybeDeferred(self.mbox.fetch, messages, uid=uid, body=_query_needs_body(query)).addCallback(
+            iter
+        ).addCallback(self._IMAP4Server__cbFetch, tag, query, uid).addErrback(
+            self._IMAP4Server__ebFetch, tag
+        )
+
+    # El despacho de comandos usa la tupla select_FETCH de la clase base, que guarda su propio do_FETCH.
+    select_FETCH = (do_FETCH,) + imap4.IMAP4Server.select_FETCH[1:]
+
+
 # Clase que centraliza la creación de servidores IMAP,
 # asegurando que cada conexión utilice la misma configuración y mecanismos de autenticación.
 class IMAPFactory(protocol.Factory):
+    # Mecanismos de autenticación aceptados, compartidos por todas las conexiones.
+    CHALLENGERS = {
+        b"LOGIN": imap4.LOGINCredentials,
+        b"PLAIN": imap4.PLAINCredentials,
+    }
+
     # Constructor:
     # portal: instancia de portal.Portal que se utiliza para la autenticación y obtención de cuentas.
     def __init__(self, portal):
@@ -344,13 +730,7 @@ class IMAPFactory(protocol.Factory):
 
     # Método para construir el protocolo IMAP4Server para cada conexión entrante.
     def buildProtocol(self, addr):
-        server = imap4.IMAP4Server()
-        server.portal = self.portal
-        server.challengers = {
-            b"LOGIN": imap4.LOGINCredentials,
-            b"PLAIN": imap4.PLAINCredentials,
-        }
-        return server
+        return DiskIMAPServer(self.portal, self.CHALLENGERS)
 
 
 
@@ -366,6 +746,7 @@ def main():
     args = parser.parse_args()
 
 
+    reactor.suggestThreadPoolSize(THREAD_POOL_SIZE)
     realm = DiskIMAPRealm(args.mail_storage)
 
     p = portal.Portal(realm, [CSVChecker(CSV_PATH)])
@@ -3,127 +3,442 @@ import io
 import argparse
 import csv
 import os
+import collections
+import string
 
-from twisted.internet import reactor, defer, protocol
+from twisted.internet import reactor, defer, protocol, task
 from twisted.mail import smtp
+from twisted.python import failure
 
 from email.message import EmailMessage
 import email.utils
 
+# Lector de CSV en C de pyarrow, opcional; si no está instalado se usa csv.reader.
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.compute
+    PYARROW_CSV = True
+except ImportError:
+    PYARROW_CSV = False
 
 
-# Clase que extiende de smtp.ESMTPClient para definir un cliuente SMTP que envia
-# un mensaje de correo individual.
+# Cantidad máxima de conexiones SMTP simultáneas que abre un SMTPConnectionPool.
+POOL_SIZE = 8
+
+# Segundos que una conexión del pool permanece abierta, sin correos en cola, esperando nuevos envíos.
+POOL_IDLE_TIMEOUT = 100
+
+# Largo máximo (en octetos, sin el salto de línea) de una línea del cuerpo enviada como 8bit (RFC 5322).
+MAX_LINE_LENGTH = 998
+
+# Pools de conexiones ya creados, por (host, puerto) del servidor SMTP.
+_POOLS = {}
+
+# Correo pendiente de envío dentro de un SMTPConnectionPool.
+# deferred se dispara cuando el servidor acepta (o rechaza) el mensaje.
+SendJob = collections.namedtuple("SendJob", ["sender", "recipient", "message", "deferred"])
+
+
+# Clase que extiende de smtp.ESMTPClient para definir un cliente SMTP que envía, sobre una
+# misma conexión, todos los correos que va tomando de la cola de un SMTPConnectionPool.
+# Entre un correo y el siguiente Twisted envía RSET y repite MAIL FROM/RCPT TO/DATA.
 class PersonalizedSMTPClient(smtp.ESMTPClient):
 
     # Constructor:
-    # sender: dirección de correo del remitente.
-    # recipient: dirección de correo del destinatario.
-    # message: mensaje (plantilla) a enviar.
+    # pool: SMTPConnectionPool del que se toman los correos a enviar.
+    # identity: identidad usada en el saludo EHLO/HELO.
     # *args, **kwargs: argumentos adicionales que se pasan a la clase base.
-    def __init__(self, sender, recipient, message, *args, **kwargs):
-        smtp.ESMTPClient.__init__(self, secret=None, identity=sender, *args, **kwargs)
-        self.sender = sender
-        self.recipient = recipient
-        self.message = message
-        self.deferred = defer.Deferred()
-
-    # Método que retorna el remitente del correo.
-    # Se devuelve la dirección y se limpia el atributo para evitar reutilización.
+    def __init__(self, pool, identity, *args, **kwargs):
+        smtp.ESMTPClient.__init__(self, secret=None, identity=identity, *args, **kwargs)
+        self.pool = pool
+        self.job = None
+        self.failed = False
+        self.idle_call = None
+
+    # Método de Twisted que inicia cada transacción (MAIL FROM), tanto tras el saludo como tras RSET.
+    # Si no hay correos en cola, la conexión queda en espera en el pool (hasta
+    # pool.idle_timeout segundos) en lugar de cerrarse de inmediato.
+    def smtpState_from(self, code, resp):
+        if not self.pool.queue and self.pool.idle_timeout and self.idle_call is None:
+            self.idle_call = reactor.callLater(self.pool.idle_timeout, self.wake)
+            self.pool.idle.append(self)
+            return None
+        return smtp.ESMTPClient.smtpState_from(self, code, resp)
+
+    # Retoma una conexión en espera: envía el siguiente correo de la cola o, si no hay
+    # (porque expiró la espera), cierra la sesión con QUIT.
+    def wake(self):
+        self._stop_idle()
+        smtp.ESMTPClient.smtpState_from(self, 250, b"")
+
+    # Cancela la espera de la conexión y la quita de la lista de conexiones libres del pool.
+    def _stop_idle(self):
+        if self.idle_call is not None:
+            if self.idle_call.active():
+                self.idle_call.cancel()
+            self.idle_call = None
+        if self in self.pool.idle:
+            self.pool.idle.remove(self)
+
+    # Método que retorna el remitente del siguiente correo de la cola.
+    # Si la cola está vacía retorna None y Twisted cierra la conexión.
     def getMailFrom(self):
 
-        result = self.sender
-        self.sender = None
-        return result
+        self.job = self.pool.next_job()
+        if self.job is None:
+            return None
+        return self.job.sender
 
-    # Método que retorna la lista de destinatarios.
+    # Método que retorna la lista de destinatarios del correo actual.
     def getMailTo(self):
 
-        return [self.recipient]
+        return [self.job.recipient]
 
-    # Método que retorna el contenido del mensaje.
-    # Se devuelve un objeto BytesIO conteniendo el mensaje codificado en UTF-8.
+    # Método que retorna el contenido del correo actual.
+    # El mensaje ya viene codificado en bytes; se devuelve dentro de un objeto BytesIO.
     def getMailData(self):
 
-        return io.BytesIO(self.message.encode("utf-8"))
+        return io.BytesIO(self.job.message)
+
+    # Método de Twisted que envía el cuerpo del correo (fase DATA).
+    # Como el mensaje ya está completo en memoria, se transforma y se escribe de una sola vez junto
+    # con la línea final "." en lugar de trocearlo con un FileSender, de modo que el reactor
+    # lo entrega al socket con la menor cantidad posible de llamadas send().
+    def smtpState_data(self, code, resp):
+        data = self.transformChunk(self.getMailData().read())
+        self.transport.writeSequence([data, b".\r\n" if data.endswith(b"\r\n") else b"\r\n.\r\n"])
+        self._expected = smtp.SUCCESS
+        self._okresponse = self.smtpState_msgSent
 
-    # Método llamado cuando el correo se ha enviado exitosamente.
+    # Método llamado cuando el servidor responde al envío del correo actual.
     # Los parámetros incluyen el código de respuesta, respuesta del servidor, cantidad de direcciones aceptadas,
     # lista de direcciones y log.
-    # Se marca el Deferred como exitoso.
+    # Se marca el Deferred del correo como exitoso si el destinatario fue aceptado y el servidor
+    # respondió con éxito al final de DATA; si no, se marca con SMTPDeliveryError.
     def sentMail(self, code, resp, numOk, addresses, log):
 
-        self.deferred.callback(True)
+        job, self.job = self.job, None
+        if numOk and code in smtp.SUCCESS:
+            job.deferred.callback(True)
+        else:
+            job.deferred.errback(smtp.SMTPDeliveryError(code, resp, log.str()))
+
+    # Método llamado ante un error de la sesión SMTP; se notifica al correo en curso.
+    def sendError(self, exc):
+        self.failed = True
+        job, self.job = self.job, None
+        if job is not None:
+            job.deferred.errback(exc)
+        smtp.ESMTPClient.sendError(self, exc)
 
+    # Método llamado al cerrarse la conexión; se avisa al pool para que reparta la cola restante.
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.ESMTPClient.connectionLost(self, reason)
+        self._stop_idle()
+        job, self.job = self.job, None
+        if job is not None:
+            self.failed = True
+            job.deferred.errback(reason)
+        self.pool.connection_closed(reason, self.failed)
 
 
-# Clase que extiende de CLientFactory, se encarga de crear instancias de clientes para cada conexion al servidor SMTP.
+
+# Clase que extiende de CLientFactory, se encarga de crear el cliente de una conexión del pool.
 class SMTPClientFactory(protocol.ClientFactory):
 
     # Constructor:
-    # sender: dirección del remitente.
-    # recipient: dirección del destinatario.
-    # message: mensaje a enviar.
-    def __init__(self, sender, recipient, message):
-        self.sender = sender
-        self.recipient = recipient
-        self.message = message
-        self.deferred = defer.Deferred()
+    # pool: SMTPConnectionPool al que pertenece la conexión.
+    def __init__(self, pool):
+        self.pool = pool
 
     # Método para construir el protocolo SMTP personalizado para la conexión.
     # Entrada: addr (dirección del servidor)
     # Salida: instancia de PersonalizedSMTPClient.
     def buildProtocol(self, addr):
-        p = PersonalizedSMTPClient(self.sender, self.recipient, self.message)
-        p.deferred.addBoth(self._finish)
+        p = PersonalizedSMTPClient(self.pool, self.pool.identity)
+        p.factory = self
         return p
 
-    # Método interno para finalizar el proceso, callback compartido.
-    # Se encarga de notificar el Deferred general de la fábrica.
-    def _finish(self, result):
-        if not self.deferred.called:
-            self.deferred.callback(result)
-        return result
-
     # Método llamado si la conexión falla.
-    # Se notifica el Deferred con un error.
+    # Se notifica al pool con un error.
     def clientConnectionFailed(self, connector, reason):
-        self.deferred.errback(reason)
+        self.pool.connection_closed(reason, True)
+
+
+# Clase que mantiene hasta 'size' conexiones SMTP hacia un mismo servidor y reparte entre ellas
+# una cola de correos, de modo que cada conexión (y su saludo EHLO) se reutiliza para varios envíos.
+# Las conexiones sin trabajo quedan abiertas hasta idle_timeout segundos a la espera de más correos.
+class SMTPConnectionPool:
+
+    # Constructor:
+    # host: servidor SMTP al que se conecta.
+    # port: puerto del servidor.
+    # identity: identidad usada en el saludo de cada conexión.
+    # size: cantidad máxima de conexiones simultáneas.
+    # idle_timeout: segundos que una conexión libre espera antes de cerrarse (0 la cierra al instante).
+    def __init__(self, host, port, identity, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.identity = identity
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.queue = collections.deque()
+        self.idle = collections.deque()
+        self.active = 0
+        self.closed_waiters = []
+
+    # Agrega un correo a la cola y retorna un Deferred que se dispara al terminar su envío.
+    # Si hay una conexión libre se reutiliza; si no, se abre una nueva (respetando el límite).
+    def send(self, sender, recipient, message):
+        d = defer.Deferred()
+        self.queue.append(SendJob(sender, recipient, message, d))
+        if self.idle:
+            self.idle[0].wake()
+        else:
+            self._fill()
+        return d
+
+    # Retorna el siguiente correo de la cola, o None si está vacía.
+    def next_job(self):
+        return self.queue.popleft() if self.queue else None
+
+    # Abre conexiones nuevas mientras haya correos en cola y no se alcance el límite.
+    def _fill(self):
+        while self.active < self.size and self.active < len(self.queue):
+            self.active += 1
+            reactor.connectTCP(self.host, self.port, SMTPClientFactory(self))
+
+    # Método llamado cuando una conexión se cierra (o no se pudo abrir).
+    # Si quedan correos en cola se abren nuevas conexiones; si la conexión falló y no queda
+    # ninguna otra activa, los correos pendientes se marcan con el mismo error.
+    def connection_closed(self, reason, failed):
+        self.active -= 1
+        if self.active == 0:
+            waiters, self.closed_waiters = self.closed_waiters, []
+            for d in waiters:
+                d.callback(None)
+        if not self.queue:
+            return
+        if failed and self.active == 0:
+            while self.queue:
+                self.queue.popleft().deferred.errback(reason)
+        elif not failed:
+            self._fill()
+
+    # Cierra el pool: las conexiones en espera (y las que terminen su correo actual) envían QUIT
+    # en lugar de quedar abiertas. Retorna un Deferred que se dispara cuando ya no queda ninguna
+    # conexión activa. El pool se quita de _POOLS, de modo que un envío posterior crea uno nuevo.
+    def close(self):
+        if _POOLS.get((self.host, self.port)) is self:
+            del _POOLS[(self.host, self.port)]
+        self.idle_timeout = 0
+        while self.idle:
+            self.idle[0].wake()
+        if self.active == 0:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.closed_waiters.append(d)
+        return d
+
+
+
+# Función que retorna el pool de conexiones para (host, port), creándolo la primera vez.
+def get_pool(host, port, identity):
+    pool = _POOLS.get((host, port))
+    if pool is None:
+        pool = _POOLS[(host, port)] = SMTPConnectionPool(host, port, identity)
+    return pool
+
 
 #Esta función se encarga de enviar correos electrónicos a todos los destinatarios listados en el CSV de forma asíncrona.
+# Los encabezados se serializan una sola vez con EmailMessage, partidos alrededor de la dirección del
+# destinatario. Si la plantilla solo usa {name} (sin formato ni conversión), se parte en sus trozos
+# literales y el cuerpo de cada destinatario se arma uniéndolos con su nombre; si no, se usa
+# message_template.format(name=...) por destinatario. Si alguna línea del cuerpo supera
+# MAX_LINE_LENGTH octetos, ese correo se arma completo con EmailMessage (ver _render_message).
+# Todos los correos del envío comparten el mismo encabezado Date, calculado una sola vez.
+# Como la dirección se copia tal cual en el encabezado To (y en RCPT TO), los destinatarios que
+# contienen saltos de línea se rechazan y se informan como un envío con error.
+# Un DeferredSemaphore limita los correos en curso a la cantidad de conexiones del pool, de modo
+# que cada una de las sesiones concurrentes siempre tenga el siguiente correo listo.
+# Los destinatarios se leen del CSV a medida que se liberan lugares en el semáforo (con task.cooperate,
+# sin bloquear el reactor), así que solo hay en memoria los correos en curso. El resultado de cada
+# envío se muestra apenas termina y solo se lleva la cuenta de los envíos pendientes.
 # host: Dominio del servidor SMTP al que se conectara
 # port: Puerto al que se conectara al servidor
 # sender: El remitente que envia el correo
-# recipients_info: Informacion del usuario destinatario
+# csv_file: Archivo CSV con los destinatarios (correo,nombre)
 # message_template: Plantilla del correo
-@defer.inlineCallbacks
-def send_all_emails(host, port, sender, recipients_info, message_template):
-
-    deferreds = []
-    for recipient_email, name in recipients_info:
-
-        msg = EmailMessage()
-        msg['Subject'] = "Correo personalizado"
-        msg['From'] = sender
-        msg['To'] = recipient_email
-        msg['Date'] = email.utils.formatdate(localtime=True)
-        msg.set_content(message_template.format(name=name))
-        mime_message = msg.as_string()
-
-        print("Enviando correo a:", recipient_email)
-        factory = SMTPClientFactory(sender, recipient_email, mime_message)
-        reactor.connectTCP(host, port, factory)
-        deferreds.append(factory.deferred)
+# Retorna un Deferred que se dispara cuando terminan todos los envíos, se cerraron (con QUIT) las
+# conexiones del pool y ya se detuvo el reactor.
+def send_all_emails(host, port, sender, csv_file, message_template):
+
+    date_header = email.utils.formatdate(localtime=True)
+
+    base_msg = EmailMessage()
+    base_msg['Subject'] = "Correo personalizado"
+    base_msg['From'] = sender
+    base_msg['Date'] = date_header
+    base_msg.set_content("", cte="8bit")
+    static_headers = base_msg.as_string().partition("\n\n")[0]
+
+    header_pre, _, header_suf = ("To: {TO}\n" + static_headers + "\n\n").encode("utf-8").partition(b"{TO}")
+    body_parts = _split_template(message_template)
+    if body_parts is not None and body_parts[-1] and not body_parts[-1].endswith(b"\n"):
+        body_parts[-1] += b"\n"
+    if body_parts is not None:
+        name_fields = len(body_parts) - 1
+        literal_line = _max_line_length(b"".join(body_parts))
+
+    pool = get_pool(host, port, sender)
+    sem = defer.DeferredSemaphore(pool.size)
+    all_sent = defer.Deferred()
+    total = 0
+    pending = 0
+    reading = True
+
+    def finished(result):
+        nonlocal pending
+        sem.release()
+        _print_result(result)
+        pending -= 1
+        if not pending and not reading:
+            all_sent.callback(None)
+
+    def send_jobs():
+        nonlocal total, pending
+        for recipient_email, name in iter_recipients(csv_file):
+
+            total += 1
+            if "\r" in recipient_email or "\n" in recipient_email:
+                _print_result(failure.Failure(ValueError("Destinatario inválido: {!r}".format(recipient_email))))
+                continue
+            yield sem.acquire()
+            to = recipient_email.encode("utf-8")
+            name_bytes = name.encode("utf-8")
+            if body_parts is not None and literal_line + name_fields * len(name_bytes) <= MAX_LINE_LENGTH:
+                body = name_bytes.join(body_parts)
+                if not body.endswith(b"\n"):
+                    body += b"\n"
+            else:
+                text = message_template.format(name=name)
+                body = _render_body(text)
+                if _max_line_length(body) > MAX_LINE_LENGTH:
+                    body = None
+            if body is None:
+                mime_message = _render_message(sender, recipient_email, date_header, text)
+            else:
+                mime_message = b"".join((header_pre, to, header_suf, body))
+
+            print("Enviando correo a:", recipient_email)
+            pending += 1
+            pool.send(sender, recipient_email, mime_message).addBoth(finished)
+
+    def wait_results(_):
+        nonlocal reading
+        reading = False
+        if not total:
+            print("No se encontraron destinatarios en el CSV.")
+        return all_sent if pending else None
+
+    d = task.cooperate(send_jobs()).whenDone()
+    d.addCallback(wait_results)
+    d.addErrback(lambda failure: print("Error preparando los correos:", failure.getErrorMessage()))
+    d.addBoth(lambda _: pool.close())
+    d.addBoth(lambda _: reactor.stop())
+    return d
+
+# Función que muestra el resultado de un envío (True, o un Failure si el envío falló).
+def _print_result(result):
+    if isinstance(result, failure.Failure):
+        print("Error en el envío:", result)
+    else:
+        print("Envio exitoso.")
+
+# Función que, si la plantilla solo usa el campo {name} sin formato ni conversión, retorna la lista
+# de trozos literales (en bytes) que hay entre cada {name}; en otro caso retorna None.
+def _split_template(template):
+    parsed = list(string.Formatter().parse(template))
+    if any(field is not None and (field != "name" or spec or conversion is not None)
+           for _, field, spec, conversion in parsed):
+        return None
+    pieces = [""]
+    for literal, field, _, _ in parsed:
+        pieces[-1] += literal
+        if field is not None:
+            pieces.append("")
+    return [piece.encode("utf-8") for piece in pieces]
+
+# Función que codifica el cuerpo de un correo (UTF-8, 8bit) terminado en salto de línea.
+def _render_body(text):
+    if not text.endswith("\n"):
+        text += "\n"
+    return text.encode("utf-8")
+
+# Función que retorna el largo (en octetos) de la línea más larga de un cuerpo en bytes.
+def _max_line_length(body):
+    return max(len(line) for line in body.split(b"\n"))
+
+# Función que arma un correo completo con EmailMessage, que elige la codificación del cuerpo
+# (quoted-printable o base64) cuando tiene líneas demasiado largas para enviarse como 8bit.
+def _render_message(sender, recipient_email, date_header, text):
+    msg = EmailMessage()
+    msg['Subject'] = "Correo personalizado"
+    msg['From'] = sender
+    msg['To'] = recipient_email
+    msg['Date'] = date_header
+    msg.set_content(text)
+    return msg.as_string().encode("utf-8")
+
+# Generador que recorre el CSV de destinatarios (correo,nombre) y entrega tuplas (correo, nombre)
+# a medida que se leen, sin cargar el archivo completo en memoria. Las filas con menos de dos
+# columnas se omiten y de las demás se usan las dos primeras.
+# Con pyarrow el archivo se parsea en C por bloques y los espacios se recortan de forma vectorizada.
+# pyarrow no admite filas con columnas de más: si encuentra una (o si no está instalado) se sigue
+# con csv.reader desde la primera fila que aún no se entregó.
+def iter_recipients(csv_file):
+    delivered = 0
+    if PYARROW_CSV:
+        try:
+            reader = pyarrow.csv.open_csv(
+                csv_file,
+                read_options=pyarrow.csv.ReadOptions(column_names=["email", "name"]),
+                parse_options=pyarrow.csv.ParseOptions(invalid_row_handler=_skip_short_row),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    column_types={"email": pyarrow.string(), "name": pyarrow.string()}))
+        except pyarrow.ArrowInvalid:
+            pass
+        else:
+            try:
+                for batch in reader:
+                    emails = pyarrow.compute.utf8_trim_whitespace(batch.column(0)).to_pylist()
+                    names = pyarrow.compute.utf8_trim_whitespace(batch.column(1)).to_pylist()
+                    for row in zip(emails, names):
+                        delivered += 1
+                        yield row
+                return
+            except pyarrow.ArrowInvalid:
+                pass
+            finally:
+                reader.close()
 
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
 
+        for row in reader:
+            if len(row) >= 2:
+                if delivered:
+                    delivered -= 1
+                    continue
+                email = row[0].strip()
+                name = row[1].strip()
+                yield (email, name)
 
-    results = yield defer.DeferredList(deferreds, consumeErrors=True)
-    for success, result in results:
-        if success:
-            print("Envio exitoso.")
-        else:
-            print("Error en el envío:", result)
-    reactor.stop()
+# Función usada por pyarrow ante una fila con una cantidad de columnas distinta de la esperada:
+# las filas con menos columnas se omiten (como en csv.reader) y las que tienen de más son un error.
+def _skip_short_row(row):
+    return "skip" if row.actual_columns < row.expected_columns else "error"
 
 # Función para parsear los argumentos de la línea de comandos.
 # No recibe argumentos y retorna un objeto con los parámetros:
@@ -154,18 +469,8 @@ def main():
     port = 2525
 
 
-    recipients_info = []
-    with open(csv_file, newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-
-        for row in reader:
-            if len(row) >= 2:
-                email = row[0].strip()
-                name = row[1].strip()
-                recipients_info.append((email, name))
-
-    if not recipients_info:
-        print("No se encontraron destinatarios en el CSV.")
+    if not os.path.exists(csv_file):
+        print("El archivo CSV no existe.")
         return
 
 
@@ -177,7 +482,7 @@ def main():
         message_template = mf.read()
 
 
-    send_all_emails(host, port, sender, recipients_info, message_template)
+    send_all_emails(host, port, sender, csv_file, message_template)
     reactor.run()
 
 
@@ -1,8 +1,19 @@
 import os
 import time
 import argparse
+import itertools
+from twisted.application import reactors
+
+# Reactor de Twisted opcional, indicado por nombre corto en la variable de entorno SMTP_REACTOR
+# (p. ej. "epoll", "poll" o un reactor basado en io_uring registrado por un plugin).
+# Debe instalarse antes de importar twisted.mail.smtp, que importa el reactor global;
+# si no se indica, se usa el reactor por defecto de la plataforma (epoll en Linux).
+SMTP_REACTOR = os.environ.get("SMTP_REACTOR")
+if SMTP_REACTOR:
+    reactors.installReactor(SMTP_REACTOR)
+
 from twisted.mail import smtp
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.internet import reactor
 from twisted.cred.portal import Portal
 from zope.interface import implementer
@@ -10,7 +21,27 @@ from twisted.cred.portal import IRealm
 from twisted.application import internet, service
 from twisted.mail.imap4 import LOGINCredentials, PLAINCredentials
 
-    
+
+# Directorios de buzón (storage_path/dominio/usuario) que ya se sabe que existen,
+# para no repetir os.makedirs en cada mensaje.
+_DIR_CACHE = set()
+
+# Nombres de archivo de los mensajes: instante de arranque del servidor (ms) más un contador
+# del proceso, con relleno de ceros para que el orden lexicográfico siga el orden de llegada.
+# El contador se toma en el hilo del reactor, en el orden en que terminan de llegar los mensajes.
+_BOOT = int(time.time() * 1000)
+_SEQ = itertools.count()
+
+# Locks (FIFO) por directorio de buzón, que hacen que los mensajes de un mismo buzón se escriban
+# de a uno y en orden de llegada, para que un archivo nuevo nunca aparezca en disco antes que otro
+# con un nombre menor (el servidor IMAP asume que los mensajes nuevos se ordenan al final).
+# Los buzones distintos se escriben en paralelo.
+_WRITE_LOCKS = {}
+
+# Flags de os.open para crear (o truncar) el archivo de un mensaje; O_CLOEXEC y O_BINARY
+# solo existen en algunas plataformas.
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0)
+
 
 #Clase que implementa la interfaz IMessageDelivery de Twisted para gestionar la entrega de mensajes
 @implementer(smtp.IMessageDelivery)
@@ -22,12 +53,14 @@ class MessageDelivery:
     def __init__(self, accepted_domains, storage_path):
         self.accepted_domains = accepted_domains
         self.storage_path = storage_path
+        # Dominios aceptados en minúsculas y en bytes, para validar cada RCPT con una búsqueda O(1).
+        self._accepted = frozenset(d.lower().encode('ascii') for d in accepted_domains)
 
     # Método que retorna un encabezado "Received" para el mensaje.
     # Entrada: helo (saludo del cliente), origin (dirección del remitente), recipients (destinatarios)
-    # Salida: cadena de texto con el encabezado recibido
+    # Salida: encabezado recibido en bytes, igual que las demás líneas que llegan a Message.lineReceived
     def receivedHeader(self, helo, origin, recipients):
-        return "Received: ConsoleMessageDelivery"
+        return b"Received: ConsoleMessageDelivery"
 
     # Método para validar la dirección de origen.
     # Entrada: helo (saludo del cliente), origin (dirección del remitente)
@@ -43,14 +76,15 @@ class MessageDelivery:
     # de lo contrario, lanza una excepción SMTPBadRcpt
     def validateTo(self, user):
 
-        # Se obtiene el dominio y la parte local del destinatario, decodificando de bytes a str si es necesario.
-        domain = user.dest.domain.decode('utf-8') if isinstance(user.dest.domain, bytes) else user.dest.domain
-        local = user.dest.local.decode('utf-8') if isinstance(user.dest.local, bytes) else user.dest.local
-
-        if any(domain.lower() == d.lower() for d in self.accepted_domains):
+        # smtp.Address siempre entrega el dominio y la parte local en bytes, por lo que el dominio se busca
+        # directamente en el conjunto de dominios aceptados (ASCII); solo si es aceptado se decodifican
+        # a str el dominio y la parte local del destinatario.
+        domain = user.dest.domain
+        if domain.lower() in self._accepted:
+            domain = domain.decode('ascii')
+            local = user.dest.local.decode('utf-8')
             return lambda: Message(domain, local, self.storage_path)
-        else:
-            raise smtp.SMTPBadRcpt(user)
+        raise smtp.SMTPBadRcpt(user)
 
 # Clase que implementa la interfaz IMessage para representar y procesar un mensaje SMTP
 @implementer(smtp.IMessage)
@@ -63,36 +97,70 @@ class Message:
         self.domain = domain
         self.user = user
         self.storage_path = storage_path
-        self.lines = []
+        self.buf = bytearray()
 
     # Método que se invoca por cada línea recibida del mensaje
-    # Entrada: line (línea del mensaje, puede ser bytes o str)
-    # No tiene salida, solo agrega la línea procesada a la lista.
+    # Entrada: line (línea del mensaje en bytes; Twisted entrega siempre bytes y el encabezado
+    # Received de MessageDelivery también lo es)
+    # No tiene salida, solo agrega la línea (terminada en salto de línea) al buffer.
     def lineReceived(self, line):
-        if isinstance(line, bytes):
-            line = line.decode('utf-8', errors='replace')
-        self.lines.append(line)
+        self.buf += line
+        self.buf.append(10)
 
     # Método que se invoca al finalizar la recepción del mensaje
-    # Salida: retorna un Deferred que se resuelve exitosamente.
+    # Salida: retorna un Deferred que se resuelve cuando el mensaje queda guardado en disco.
+    # La escritura se hace en el pool de hilos del reactor para no bloquear las demás conexiones.
     def eomReceived(self):
-        message = "\n".join(self.lines)
+        buf, self.buf = self.buf, None
         destination_folder = os.path.join(self.storage_path, self.domain, self.user) # Construye la ruta del directorio destino: storage_path/dominio/usuario
-        os.makedirs(destination_folder, exist_ok=True)
-        filename = "message_{}.eml".format(int(time.time() * 1000))
+        filename = "message_{}_{:010d}.eml".format(_BOOT, next(_SEQ))
+        lock = _WRITE_LOCKS.get(destination_folder)
+        if lock is None:
+            lock = _WRITE_LOCKS[destination_folder] = defer.DeferredLock()
+        d = lock.run(threads.deferToThread, self._flush, buf, destination_folder, filename)
+        d.addBoth(self._release_lock, destination_folder, lock)
+        return d
+
+    # Descarta el lock del buzón cuando ya no queda ninguna escritura esperándolo.
+    def _release_lock(self, result, destination_folder, lock):
+        if not lock.locked and not lock.waiting and _WRITE_LOCKS.get(destination_folder) is lock:
+            del _WRITE_LOCKS[destination_folder]
+        return result
+
+    # Método que guarda el contenido del mensaje en destination_folder con el nombre filename.
+    # Se ejecuta fuera del hilo del reactor. Si el directorio estaba en _DIR_CACHE pero fue
+    # borrado, se descarta de la caché, se vuelve a crear y se reintenta una vez.
+    def _flush(self, buf, destination_folder, filename):
+        if destination_folder not in _DIR_CACHE:
+            os.makedirs(destination_folder, exist_ok=True)
+            _DIR_CACHE.add(destination_folder)
         filepath = os.path.join(destination_folder, filename)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(message)
+        try:
+            fd = os.open(filepath, _WRITE_FLAGS, 0o644)
+        except FileNotFoundError:
+            _DIR_CACHE.discard(destination_folder)
+            os.makedirs(destination_folder, exist_ok=True)
+            _DIR_CACHE.add(destination_folder)
+            fd = os.open(filepath, _WRITE_FLAGS, 0o644)
+        try:
+            data = memoryview(buf)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
         print("Mensaje guardado en:", filepath)
-        self.lines = None
-        return defer.succeed(None)
 
     def connectionLost(self):
-        self.lines = None
+        self.buf = None
 
 # Clase que extiende SMTPFactory para crear un servidor SMTP personalizado.
 class NewSMTPFactory(smtp.SMTPFactory):
     protocol = smtp.ESMTP
+    # Mecanismos de autenticación aceptados, compartidos por todas las conexiones.
+    CHALLENGERS = {
+        b"LOGIN": LOGINCredentials,
+        b"PLAIN": PLAINCredentials,
+    }
 
     # Constructor:
     # portal: instancia de Portal para gestionar autenticaciones.
@@ -109,10 +177,7 @@ class NewSMTPFactory(smtp.SMTPFactory):
     def buildProtocol(self, addr):
         p = smtp.SMTPFactory.buildProtocol(self, addr)
         p.delivery = self.delivery
-        p.challengers = {
-            b"LOGIN": LOGINCredentials,
-            b"PLAIN": PLAINCredentials
-        }
+        p.challengers = self.CHALLENGERS
         return p
 
 